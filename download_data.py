@@ -16,6 +16,7 @@ Configuration:
 
 import os
 import sys
+import logging
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -29,6 +30,7 @@ load_dotenv()
 
 # Configuration
 DATA_ROOT = os.getenv("DATA_ROOT", "data")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
 
 # CSV Files to process - UPDATE THESE PATHS
 CSV_FILES = {
@@ -56,6 +58,7 @@ def validate_csv_files():
 
 def main():
     """Main execution function."""
+    logging.basicConfig(level=LOG_LEVEL, format="%(message)s")
     print("🚀 Face Matching Data Download Script")
     print("=" * 50)
     print()
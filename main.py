@@ -1,111 +1,385 @@
 from __future__ import annotations
 import os
+import csv
+import base64
+import asyncio
+import logging
+import queue
+import threading
 from pathlib import Path
-from typing import List, Dict
-import pandas as pd
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple, Union
 from tqdm import tqdm
+from tqdm.contrib.logging import logging_redirect_tqdm
 from dotenv import load_dotenv
 
-from src.utils.files import list_image_files, choose_passport_and_selfie
-from src.adapters.face_client import match_passport_and_selfie
-from src.utils.sheets_uploader import upload_to_sheets
+from src.utils.files import list_image_files, choose_passport_and_selfie, file_digest
+from src.utils.assessment import extract_id_from_filename, should_files_match, assess_match_result
+from src.adapters.face_client import (
+    FACE_BATCH_SIZE,
+    FaceMatchResult,
+    lookup_cached_match,
+    match_passport_and_selfie,
+    match_passport_and_selfie_batch,
+    prune_cache,
+)
 
 load_dotenv()
 
 DATA_ROOT = Path(os.getenv("DATA_ROOT", "data/CC"))
 RESULTS_CSV = Path(os.getenv("RESULTS_CSV", "results/CC_results.csv"))
 THRESHOLD = float(os.getenv("FACE_MATCH_THRESHOLD", "0.80"))
+CONCURRENCY = int(os.getenv("FACE_CONCURRENCY", "16"))
+# Drive the API calls from one asyncio event loop instead of a thread per request (needs aiohttp)
+USE_ASYNC = os.getenv("FACE_ASYNC", "0").lower() in ("1", "true", "yes")
+# Threaded path: disk reader threads and how many loaded pairs may wait for an API worker
+READERS = int(os.getenv("FACE_READERS", "4"))
+PIPELINE_DEPTH = int(os.getenv("FACE_PIPELINE_DEPTH", "32"))
+SAVE_CROPS = os.getenv("SAVE_CROPS", "0").lower() in ("1", "true", "yes")
+CROPS_DIR = Path(os.getenv("CROPS_DIR", str(RESULTS_CSV.parent / "crops")))
+# all | mismatched_ids | matched_ids - only call the Face API for pairs whose filename IDs (mis)match
+ONLY_SCORE = os.getenv("ONLY_SCORE", "all")
+# Per-request retries/failures are logged at WARNING; DEBUG adds per-file messages
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
 
-def _extract_id_from_filename(filepath: Path) -> str:
-    """Extract ID from filename by splitting on underscore and taking first part."""
-    filename = filepath.stem
-    parts = filename.split('_')
-    return parts[0] if parts else filename
-
-def _should_files_match(passport_path: Path, face_photo_path: Path) -> bool:
-    """Check if files should match based on their filename IDs."""
-    passport_id = _extract_id_from_filename(passport_path)
-    face_photo_id = _extract_id_from_filename(face_photo_path)
-    
-    # Return True if both IDs are non-empty and match
-    return bool(passport_id and face_photo_id and passport_id == face_photo_id)
-
-def _assess_match_result(should_match: bool, actual_match: bool) -> str:
-    """Assess the difference between expected and actual match results."""
-    if should_match and actual_match:
-        return "true_positive"
-    elif not should_match and not actual_match:
-        return "true_negative"
-    elif should_match and not actual_match:
-        return "false_negative"
-    else:  # not should_match and actual_match
-        return "false_positive"
+FIELDS = [
+    "maid_id", "passport_path", "face_photo_path", "passport_id", "face_photo_id",
+    "should_match", "similarity", "match", "match_assessment", "reason", "status",
+]
 
+def _save_b64_image(b64: Optional[str], out_path: Path) -> None:
+    """Decode a base64 face crop and write it to disk."""
+    if not b64:
+        return
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    # Drop whitespace first (line-wrapped base64 is valid, but a newline would shift
+    # the slices), then decode in 64 KiB slices (a multiple of 4, so each slice is
+    # whole base64 quanta) and write to a temp file first so a crash never leaves a
+    # truncated crop behind
+    b64 = "".join(b64.split())
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        for i in range(0, len(b64), 65536):
+            f.write(base64.b64decode(b64[i:i + 65536]))
+    os.replace(tmp_path, out_path)
 
-def run() -> None:
-    maid_dirs = [p for p in DATA_ROOT.iterdir() if p.is_dir()]
 
-    rows: List[Dict] = []
-    for maid_dir in tqdm(maid_dirs, desc="maids"):
-        maid_id = maid_dir.name
-        images = list_image_files(maid_dir)
-        if len(images) < 2:
-            rows.append({"maid_id": maid_id, "status": "skipped:not_enough_images"})
-            continue
+@dataclass
+class _MaidPair:
+    """The passport/selfie pair chosen for one maid, plus what the filenames say about it."""
+    maid_id: str
+    passport: Path
+    selfie: Path
+    passport_path: str
+    face_photo_path: str
+    passport_id: str
+    face_photo_id: str
+    should_match: bool
+    skip_reason: Optional[str]
+
+
+def _select_pair(maid_dir: Path) -> Union[_MaidPair, Dict]:
+    """Choose the pair to match for a maid directory, or return its skipped row."""
+    maid_id = maid_dir.name
+    images = list_image_files(maid_dir)
+    if len(images) < 2:
+        return {"maid_id": maid_id, "status": "skipped:not_enough_images"}
+
+    passport, selfie = choose_passport_and_selfie(images)
+    if not passport or not selfie:
+        return {"maid_id": maid_id, "status": "skipped:cant_choose_pair"}
+
+    # Check if files should match based on filename IDs
+    passport_id = extract_id_from_filename(passport)
+    face_photo_id = extract_id_from_filename(selfie)
+    should_match = should_files_match(passport_id, face_photo_id)
+
+    # Pairs the user doesn't need scored keep their row but skip the API call
+    skip_reason = None
+    if ONLY_SCORE == "mismatched_ids" and should_match:
+        skip_reason = "skipped:ids_match"
+    elif ONLY_SCORE == "matched_ids" and not should_match:
+        skip_reason = "skipped:ids_mismatch"
+
+    return _MaidPair(maid_id, passport, selfie, str(passport), str(selfie), passport_id, face_photo_id, should_match, skip_reason)
+
+
+def _lookup(pair: _MaidPair) -> Tuple[Optional[FaceMatchResult], Optional[Tuple[bytes, bytes]]]:
+    """Resolve a pair without the API if possible; otherwise return the digests to call it with."""
+    if pair.skip_reason:
+        return FaceMatchResult(similarity=0.0, decision=pair.should_match, reason=pair.skip_reason, meta={}), None
+
+    # Hash from disk first so cache hits never load the images into memory
+    digests = (file_digest(pair.passport), file_digest(pair.selfie))
+    return lookup_cached_match(*digests, threshold=THRESHOLD, save_crops=SAVE_CROPS), digests
+
+
+def _result_row(pair: _MaidPair, res: FaceMatchResult) -> Dict:
+    if SAVE_CROPS and not pair.skip_reason:
+        _save_b64_image(res.passport_crop_b64, CROPS_DIR / pair.maid_id / "passport.jpg")
+        _save_b64_image(res.selfie_crop_b64, CROPS_DIR / pair.maid_id / "selfie.jpg")
+
+    actual_match = bool(res.decision)
+    match_assessment = assess_match_result(pair.should_match, actual_match)
+    status = pair.skip_reason or "ok"
+    if res.api_error:
+        # Not a real non-match: keep it out of the assessment and the summary totals
+        match_assessment = "error"
+        status = f"error:{res.reason}"
+
+    return {
+        "maid_id": pair.maid_id,
+        "passport_path": pair.passport_path,
+        "face_photo_path": pair.face_photo_path,
+        "passport_id": pair.passport_id,
+        "face_photo_id": pair.face_photo_id,
+        "should_match": pair.should_match,
+        "similarity": res.similarity,
+        "match": actual_match,
+        "match_assessment": match_assessment,
+        "reason": res.reason,
+        "status": status,
+    }
+
+
+def _error_row(pair: _MaidPair, e: Exception) -> Dict:
+    return {
+        "maid_id": pair.maid_id,
+        "passport_path": pair.passport_path,
+        "face_photo_path": pair.face_photo_path,
+        "passport_id": pair.passport_id,
+        "face_photo_id": pair.face_photo_id,
+        "should_match": False,
+        "similarity": 0.0,
+        "match": False,
+        "match_assessment": "error",
+        "reason": f"error:{e}",
+        "status": f"error:{e}",
+    }
+
+
+def _run_pipelined(maid_dirs: List[Path], on_row: Callable[[Dict], None]) -> None:
+    """
+    Process maids as a three-stage pipeline so disk and network overlap.
+
+    Reader threads choose each pair, check the cache and load the images;
+    loaded pairs wait in a bounded queue (backpressure for the readers) for
+    the API worker threads; finished rows are handed to `on_row` on this
+    thread, which is the only one touching the CSV. If `on_row` raises (a
+    write error, Ctrl-C), the readers are stopped and the exception re-raised.
+    """
+    jobs: queue.Queue = queue.Queue(maxsize=PIPELINE_DEPTH)
+    rows: queue.Queue = queue.Queue()
+    done = object()
+    stop = threading.Event()
+
+    def put_job(job: Tuple) -> None:
+        # Wait for room in slices, so a reader never blocks forever once nobody scores
+        while not stop.is_set():
+            try:
+                jobs.put(job, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def read(maid_dir: Path) -> None:
+        if stop.is_set():
+            return
+        pair = None
+        try:
+            pair = _select_pair(maid_dir)
+            if isinstance(pair, dict):
+                rows.put(pair)
+                return
+            res, digests = _lookup(pair)
+            if res is not None:
+                rows.put(_result_row(pair, res))
+                return
+            put_job((pair, pair.passport.read_bytes(), pair.selfie.read_bytes(), digests))
+        except Exception as e:
+            # Every maid must yield exactly one row or the writer below would wait forever
+            rows.put(_error_row(pair, e) if isinstance(pair, _MaidPair) else {"maid_id": maid_dir.name, "status": f"error:{e}"})
+
+    def score() -> None:
+        saw_done = False
+        while not saw_done:
+            job = jobs.get()
+            if job is done:
+                return
+            # With FACE_BATCH_SIZE > 1, send whatever else is already loaded in the same request
+            batch = [job]
+            while len(batch) < FACE_BATCH_SIZE:
+                try:
+                    job = jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is done:
+                    saw_done = True
+                    break
+                batch.append(job)
+
+            try:
+                if len(batch) == 1:
+                    pair, passport_bytes, selfie_bytes, digests = batch[0]
+                    results = [match_passport_and_selfie(
+                        passport_bytes,
+                        selfie_bytes,
+                        threshold=THRESHOLD,
+                        save_crops=SAVE_CROPS,
+                        digests=digests,
+                        check_cache=False  # the reader's _lookup already missed
+                    )]
+                else:
+                    results = match_passport_and_selfie_batch(
+                        [(passport_bytes, selfie_bytes) for _, passport_bytes, selfie_bytes, _ in batch],
+                        threshold=THRESHOLD,
+                        save_crops=SAVE_CROPS,
+                        digests=[digests for _, _, _, digests in batch],
+                        check_cache=False
+                    )
+            except Exception as e:
+                for pair, _, _, _ in batch:
+                    rows.put(_error_row(pair, e))
+                continue
+            # One row per pair either way: a failure writing one pair's row doesn't touch the others
+            for (pair, _, _, _), res in zip(batch, results):
+                try:
+                    row = _result_row(pair, res)
+                except Exception as e:
+                    row = _error_row(pair, e)
+                rows.put(row)
+
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as scorers, ThreadPoolExecutor(max_workers=READERS) as readers:
+        for _ in range(CONCURRENCY):
+            scorers.submit(score)
+        for maid_dir in maid_dirs:
+            readers.submit(read, maid_dir)
+
+        try:
+            for _ in range(len(maid_dirs)):
+                on_row(rows.get())
+        except BaseException:
+            stop.set()
+            readers.shutdown(cancel_futures=True)
+            # Drop loaded pairs nobody will score, so there is room for `done` below
+            while True:
+                try:
+                    jobs.get_nowait()
+                except queue.Empty:
+                    break
+            raise
+        finally:
+            for _ in range(CONCURRENCY):
+                jobs.put(done)
+
 
-        passport, selfie = choose_passport_and_selfie(images)
-        if not passport or not selfie:
-            rows.append({"maid_id": maid_id, "status": "skipped:cant_choose_pair"})
-            continue
+async def _process_maid_async(maid_dir: Path, session, sem: asyncio.Semaphore) -> Dict:
+    """Process one maid with disk work on worker threads and the API call on the event loop."""
+    from src.adapters.face_client_async import match_async
 
+    async with sem:
+        pair = None
         try:
-            res = match_passport_and_selfie(
-                passport.read_bytes(),
-                selfie.read_bytes(),
-                threshold=THRESHOLD
-            )
-
-            # Check if files should match based on filename IDs
-            should_match = _should_files_match(passport, selfie)
-            actual_match = bool(res.decision)
-            match_assessment = _assess_match_result(should_match, actual_match)
-
-            rows.append({
-                "maid_id": maid_id,
-                "passport_path": str(passport),
-                "face_photo_path": str(selfie),
-                "passport_id": _extract_id_from_filename(passport),
-                "face_photo_id": _extract_id_from_filename(selfie),
-                "should_match": should_match,
-                "similarity": res.similarity,
-                "match": actual_match,
-                "match_assessment": match_assessment,
-                "reason": res.reason,
-                "status": "ok",
-            })
+            pair = await asyncio.to_thread(_select_pair, maid_dir)
+            if isinstance(pair, dict):
+                return pair
+
+            res, digests = await asyncio.to_thread(_lookup, pair)
+            if res is None:
+                passport_bytes = await asyncio.to_thread(pair.passport.read_bytes)
+                selfie_bytes = await asyncio.to_thread(pair.selfie.read_bytes)
+                res = await match_async(
+                    session,
+                    passport_bytes,
+                    selfie_bytes,
+                    threshold=THRESHOLD,
+                    save_crops=SAVE_CROPS,
+                    digests=digests,
+                    check_cache=False  # _lookup already missed
+                )
+            return await asyncio.to_thread(_result_row, pair, res)
 
         except Exception as e:
-            rows.append({
-                "maid_id": maid_id,
-                "passport_path": str(passport) if passport else "",
-                "face_photo_path": str(selfie) if selfie else "",
-                "passport_id": _extract_id_from_filename(passport) if passport else "",
-                "face_photo_id": _extract_id_from_filename(selfie) if selfie else "",
-                "should_match": False,
-                "similarity": 0.0,
-                "match": False,
-                "match_assessment": "error",
-                "reason": f"error:{e}",
-                "status": f"error:{e}",
-            })
-
-    # write CSV
+            # Same rows as the threaded path, so one bad maid dir doesn't end the run
+            return _error_row(pair, e) if isinstance(pair, _MaidPair) else {"maid_id": maid_dir.name, "status": f"error:{e}"}
+
+
+async def _run_async(maid_dirs: List[Path], on_row: Callable[[Dict], None]) -> None:
+    from src.adapters.face_client_async import create_session
+
+    sem = asyncio.Semaphore(CONCURRENCY)
+    async with create_session(CONCURRENCY) as session:
+        tasks = [_process_maid_async(maid_dir, session, sem) for maid_dir in maid_dirs]
+        for next_row in asyncio.as_completed(tasks):
+            on_row(await next_row)
+
+
+@dataclass
+class _RunSummary:
+    """Running totals for the end-of-run summary, updated as rows complete."""
+    n_ok: int = 0
+    n_match: int = 0
+    n_should: int = 0
+    n_correct: int = 0
+    sim_sum: float = 0.0
+
+    def add(self, row: Dict) -> None:
+        if row["status"] != "ok":
+            return
+        self.n_ok += 1
+        self.n_match += int(row["match"])
+        self.sim_sum += row["similarity"]
+        self.n_should += int(row["should_match"])
+        self.n_correct += int(row["match_assessment"] in ("true_positive", "true_negative"))
+
+    def report(self, total: int) -> None:
+        n_ok = self.n_ok
+        avg_similarity = self.sim_sum / n_ok if n_ok else 0.0
+        print(f"📊 Processed {n_ok}/{total} maids successfully")
+        if n_ok:
+            print(f"✅ Matches: {self.n_match}/{n_ok} (expected by filename IDs: {self.n_should})")
+            print(f"📈 Average similarity: {avg_similarity:.3f}")
+            print(f"🎯 Correct assessments: {self.n_correct}/{n_ok} ({self.n_correct / n_ok * 100:.1f}%)")
+
+
+def run() -> None:
+    # scandir's is_dir() uses the cached d_type, avoiding a stat() per entry
+    with os.scandir(DATA_ROOT) as entries:
+        maid_dirs = [Path(e.path) for e in entries if e.is_dir()]
+
+    summary = _RunSummary()
+
+    # Rows are written as they complete so partial results survive a crash
     RESULTS_CSV.parent.mkdir(parents=True, exist_ok=True)
-    df = pd.DataFrame(rows)
-    df.to_csv(RESULTS_CSV, index=False)
-    
-    # Upload to Google Sheets
+    with open(RESULTS_CSV, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS, restval="")
+        writer.writeheader()
+        # Redraw at most ~200 times per run (and twice a second) rather than per row
+        pbar = tqdm(total=len(maid_dirs), desc="maids", miniters=max(1, len(maid_dirs) // 200), mininterval=0.5)
+
+        def on_row(row: Dict) -> None:
+            writer.writerow(row)
+            f.flush()
+            summary.add(row)
+            pbar.update(1)
+
+        # Log records are printed above the progress bar instead of through it
+        with logging_redirect_tqdm():
+            if USE_ASYNC:
+                asyncio.run(_run_async(maid_dirs, on_row))
+            else:
+                _run_pipelined(maid_dirs, on_row)
+        pbar.close()
+
+    summary.report(len(maid_dirs))
+    prune_cache()
+
+    # Upload to Google Sheets (imported here: the uploader pulls in gspread and
+    # google-auth, which the matching run itself doesn't need)
+    from src.utils.sheets_uploader import upload_to_sheets
     upload_to_sheets(RESULTS_CSV)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=LOG_LEVEL, format="%(message)s")
     run()
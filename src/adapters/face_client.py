@@ -1,21 +1,70 @@
 from __future__ import annotations
 import os, base64
-from typing import Dict, Any, Tuple, Optional
-from dataclasses import dataclass
-from contextlib import contextmanager
+import hashlib
+import importlib.util
+import io
+import json
+import mmap
+import struct
+from collections import OrderedDict
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Dict, Any, List, Tuple, Optional
+from dataclasses import dataclass, asdict
+import atexit
+import logging
+import threading
 import time
 import random
 
+import requests
+from requests.adapters import HTTPAdapter
+
+from ..utils.files import content_digest, file_digest
+
+logger = logging.getLogger(__name__)
+
 FACE_API_URL = os.getenv("FACE_API_URL", "http://localhost:41101")
 API_TIMEOUT = int(os.getenv("API_TIMEOUT", "30"))
-API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "3"))
+# Attempts per call, including the first (at least 1, or no request would be sent)
+API_MAX_RETRIES = max(1, int(os.getenv("API_MAX_RETRIES", "3")))
 API_RETRY_DELAY = float(os.getenv("API_RETRY_DELAY", "1.0"))
 API_TIMEOUT_RETRY_WAIT = int(os.getenv("API_TIMEOUT_RETRY_WAIT", "30"))
+# Circuit breaker: after this many failed calls in a row, fail fast for API_BREAKER_COOLDOWN seconds (0 = off)
+API_BREAKER_FAILURES = int(os.getenv("API_BREAKER_FAILURES", "5"))
+API_BREAKER_COOLDOWN = float(os.getenv("API_BREAKER_COOLDOWN", "15"))
+# Keep-alive connections kept per host; should be at least FACE_CONCURRENCY
+API_POOL_MAXSIZE = int(os.getenv("API_POOL_MAXSIZE", "50"))
+# Pairs packed into one /api/match request by match_passport_and_selfie_batch (1 = one pair per request)
+FACE_BATCH_SIZE = int(os.getenv("FACE_BATCH_SIZE", "1"))
+# Keep the raw API response in FaceMatchResult.meta (debugging only; it can hold base64 crops)
+FACE_RETURN_META = os.getenv("FACE_RETURN_META", "0").lower() in ("1", "true", "yes")
+# Content-addressed cache of successful match results; set FACE_CACHE_DIR= (empty) to disable
+FACE_CACHE_DIR = os.getenv("FACE_CACHE_DIR", "results/.face_cache")
+# Size cap for the cache; prune_cache() drops least recently used entries beyond it (0 = no cap)
+FACE_CACHE_MAX_MB = int(os.getenv("FACE_CACHE_MAX_MB", "0"))
+# Downscale images client-side before upload (long edge in px, JPEG quality); needs Pillow
+FACE_PREPROCESS = os.getenv("FACE_PREPROCESS", "0").lower() in ("1", "true", "yes")
+FACE_PREPROCESS_MAX_SIDE = int(os.getenv("FACE_PREPROCESS_MAX_SIDE", "1024"))
+FACE_PREPROCESS_QUALITY = int(os.getenv("FACE_PREPROCESS_QUALITY", "85"))
+# Preprocessed images kept encoded in memory, so a passport matched against many selfies is resized once
+FACE_ENCODE_CACHE_SIZE = int(os.getenv("FACE_ENCODE_CACHE_SIZE", "128"))
+
+# orjson is optional; it parses the (often base64-heavy) match responses faster than json
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode("utf-8")
 
-# Import Regula Face SDK components
-from regula.facesdk.webclient.ext import FaceSdk, DetectRequest
-from regula.facesdk.webclient import MatchImage, MatchRequest
-from regula.facesdk.webclient.gen.model.image_source import ImageSource
+# Pillow is optional and only imported by _preprocess, when preprocessing is on
+PIL_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+if FACE_PREPROCESS and not PIL_AVAILABLE:
+    logger.warning("⚠️  FACE_PREPROCESS is set but Pillow is not installed; sending images unchanged. Install with: pip install pillow")
 
 @dataclass
 class FaceMatchResult:
@@ -23,222 +72,610 @@ class FaceMatchResult:
     decision: bool
     reason: str
     meta: Dict[str, Any]
+    passport_crop_b64: Optional[str] = None
+    selfie_crop_b64: Optional[str] = None
+    # The API couldn't score the pair (HTTP errors, timeouts, open circuit), as opposed to a real non-match
+    api_error: bool = False
+
+# Shared HTTP session, created lazily on first use and reused by every call/thread
+_SESSION: Optional[requests.Session] = None
+_LOCK = threading.Lock()
+
+def get_session() -> requests.Session:
+    """Return the process-wide HTTP session so REST calls reuse keep-alive connections."""
+    global _SESSION
+    if _SESSION is None:
+        with _LOCK:
+            if _SESSION is None:
+                session = requests.Session()
+                # Retries are handled by our own backoff loop, so urllib3 must not retry too
+                adapter = HTTPAdapter(pool_connections=10, pool_maxsize=API_POOL_MAXSIZE, max_retries=0)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers.update({"Content-Type": "application/json"})
+                _SESSION = session
+    return _SESSION
+
+# Circuit breaker state, shared by every thread and the asyncio client
+_BREAKER_LOCK = threading.Lock()
+_breaker_failures = 0
+_breaker_open_until = 0.0
+
+def _circuit_open() -> Optional[FaceMatchResult]:
+    """Return a fail-fast result while the breaker is open, else None."""
+    if time.monotonic() >= _breaker_open_until:
+        return None
+    return FaceMatchResult(
+        similarity=0.0,
+        decision=False,
+        reason="circuit_open",
+        api_error=True,
+        meta={"api_method": "direct_rest", "error": f"{_breaker_failures} consecutive API failures", "attempts": 0}
+    )
+
+def _record_success() -> None:
+    global _breaker_failures
+    if _breaker_failures:
+        with _BREAKER_LOCK:
+            _breaker_failures = 0
+
+def _record_failure() -> None:
+    global _breaker_failures, _breaker_open_until
+    if not API_BREAKER_FAILURES:
+        return
+    with _BREAKER_LOCK:
+        _breaker_failures += 1
+        if _breaker_failures >= API_BREAKER_FAILURES and time.monotonic() >= _breaker_open_until:
+            _breaker_open_until = time.monotonic() + API_BREAKER_COOLDOWN
+            logger.warning(f"🔌 {_breaker_failures} API failures in a row, failing fast for {API_BREAKER_COOLDOWN:.0f}s")
+
+def _close_session() -> None:
+    if _SESSION is not None:
+        _SESSION.close()
+
+atexit.register(_close_session)
+
+def _face_crop_b64(detections: list, image_index: Any, face_index: Any) -> Optional[str]:
+    """Find the base64 crop of one detected face in a match response (thumbnails=True)."""
+    for detection in detections or []:
+        if detection.get('imageIndex') != image_index:
+            continue
+        for face in detection.get('faces') or []:
+            if face.get('faceIndex') == face_index:
+                return face.get('crop')
+    return None
 
-@contextmanager
-def sdk():
-    # Regula example shows host without /api; client adds it internally.
-    # https://github.com/regulaforensics/FaceSDK-web-python-client
-    with FaceSdk(host=FACE_API_URL) as client:
-        yield client
+def _cache_path(passport_digest: bytes, selfie_digest: bytes, threshold: float) -> Optional[Path]:
+    """Location of the cached result for an image pair, or None when caching is disabled."""
+    if not FACE_CACHE_DIR:
+        return None
+    # Preprocessing changes what the API sees, so its settings are part of the key
+    # (the quality is only appended when preprocessing, so other keys are unchanged)
+    preprocessing = FACE_PREPROCESS and PIL_AVAILABLE
+    params = struct.pack("<dI", threshold, FACE_PREPROCESS_MAX_SIDE if preprocessing else 0)
+    if preprocessing:
+        params += struct.pack("<I", FACE_PREPROCESS_QUALITY)
+    key = hashlib.blake2b(passport_digest + selfie_digest + params, digest_size=32).hexdigest()
+    return Path(FACE_CACHE_DIR) / key[:2] / f"{key}.json"
 
-def match_passport_and_selfie(passport_bytes: bytes, selfie_bytes: bytes, threshold: float = 0.85) -> FaceMatchResult:
+def _load_cached(path: Optional[Path], save_crops: bool) -> Optional[FaceMatchResult]:
+    if path is None:
+        return None
+    try:
+        result = FaceMatchResult(**_json_loads(path.read_bytes()))
+    except (OSError, ValueError, TypeError):
+        return None
+    # Results cached without crops can't serve a request that wants them
+    if save_crops and not (result.passport_crop_b64 or result.selfie_crop_b64):
+        return None
+    try:
+        os.utime(path)  # mtime doubles as last-used time for prune_cache()
+    except OSError:
+        pass
+    result.meta["cache_hit"] = True
+    return result
+
+def _store_cached(path: Optional[Path], result: FaceMatchResult) -> None:
+    if path is None:
+        return
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(_json_dumps(asdict(result)))
+        os.replace(tmp, path)  # atomic, so concurrent readers never see a partial file
+    except OSError as e:
+        logger.warning(f"⚠️  Could not write face match cache {path}: {e}")
+
+def prune_cache(max_mb: Optional[int] = None) -> int:
+    """Delete least recently used cache entries until the cache fits in `max_mb` (default FACE_CACHE_MAX_MB).
+
+    Returns the number of entries removed.
+    """
+    max_bytes = (FACE_CACHE_MAX_MB if max_mb is None else max_mb) * 1024 * 1024
+    root = Path(FACE_CACHE_DIR) if FACE_CACHE_DIR else None
+    if not max_bytes or root is None or not root.is_dir():
+        return 0
+    
+    entries = []
+    total = 0
+    for path in root.glob("*/*.json"):
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+    
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            path.unlink()
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+def lookup_cached_match(passport_digest: bytes, selfie_digest: bytes, threshold: float = 0.85, save_crops: bool = False) -> Optional[FaceMatchResult]:
+    """Return a cached result for a pair of content digests (utils.files.file_digest), without needing the image bytes."""
+    return _load_cached(_cache_path(passport_digest, selfie_digest, threshold), save_crops)
+
+def match_passport_and_selfie(passport_bytes: bytes, selfie_bytes: bytes, threshold: float = 0.85, save_crops: bool = False,
+                              digests: Optional[Tuple[bytes, bytes]] = None, use_cache: bool = True,
+                              check_cache: bool = True) -> FaceMatchResult:
     """
     Match passport and selfie images using Regula Face SDK.
     
     Uses direct REST API with detectAll=True to match website behavior exactly.
     Detects ALL faces in both images and returns the HIGHEST similarity score.
+    Successful results are cached on disk by image content, so a pair that was
+    already scored (e.g. on a re-run) is answered without calling the API.
     
     Args:
         passport_bytes: Raw bytes of passport image (may contain multiple faces/ghost portraits)
         selfie_bytes: Raw bytes of selfie image (may contain multiple faces)
         threshold: Similarity threshold for match decision
+        save_crops: Also return base64 face crops of the best-matching faces, taken
+            from the thumbnails of the same match response (no extra detect calls)
+        digests: Content digests of (passport, selfie) if the caller already has them
+        use_cache: Read and write the on-disk result cache (FACE_CACHE_DIR)
+        check_cache: Look the pair up in the cache first; pass False when the caller
+            already did (lookup_cached_match) and only wants the result stored
         
     Returns:
         FaceMatchResult with the highest similarity score found among all face comparisons
     """
+    cache_path = None
+    if use_cache:
+        if digests is None:
+            digests = (content_digest(passport_bytes), content_digest(selfie_bytes))
+        cache_path = _cache_path(digests[0], digests[1], threshold)
+        cached = _load_cached(cache_path, save_crops) if check_cache else None
+        if cached is not None:
+            return cached
+    return _request_match(passport_bytes, selfie_bytes, threshold, save_crops, cache_path)
+
+def match_passport_and_selfie_paths(passport_path: Path, selfie_path: Path, threshold: float = 0.85, save_crops: bool = False,
+                                    use_cache: bool = True) -> FaceMatchResult:
+    """
+    Same as match_passport_and_selfie, but reads the images from disk itself.
     
-    # Use direct REST API with detectAll=True (EXACT website format)
+    The files are memory-mapped and base64-encoded straight from the mapping,
+    so no separate copy of each image is held in memory, and a cache hit
+    only needs the files hashed, never loaded.
+    """
+    digests = (file_digest(passport_path), file_digest(selfie_path)) if use_cache else None
+    if digests is not None:
+        cached = _load_cached(_cache_path(digests[0], digests[1], threshold), save_crops)
+        if cached is not None:
+            return cached
+    
+    with ExitStack() as stack:
+        passport, selfie = (_map_file(stack, path) for path in (passport_path, selfie_path))
+        # Already looked up above
+        return match_passport_and_selfie(passport, selfie, threshold, save_crops, digests, use_cache, check_cache=False)
+
+def _map_file(stack: ExitStack, path: Path):
+    """Read-only mapping of a file, closed with `stack` (empty files can't be mapped and are just read)."""
+    f = stack.enter_context(open(path, "rb"))
     try:
-        import requests
-        import base64
-        import json
-        
-        # Use direct REST API with detectAll=True (website format)
-        
-        # Create EXACT website format with detectAll=True
-        request_data = {
-            "images": [
-                {
-                    "data": base64.b64encode(passport_bytes).decode('utf-8'),
-                    "index": 0,
-                    "detectAll": True,
-                    "type": 3
-                },
-                {
-                    "data": base64.b64encode(selfie_bytes).decode('utf-8'),
-                    "index": 1,
-                    "detectAll": True,
-                    "type": 3
-                }
-            ]
+        return stack.enter_context(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    except ValueError:
+        return f.read()
+
+def match_passport_and_selfie_batch(pairs: List[Tuple[bytes, bytes]], threshold: float = 0.85, save_crops: bool = False,
+                                    digests: Optional[List[Tuple[bytes, bytes]]] = None, use_cache: bool = True,
+                                    check_cache: bool = True) -> List[FaceMatchResult]:
+    """
+    Match several (passport, selfie) pairs with a single /api/match request.
+    
+    Pair k is sent as images 2k and 2k+1 and only the comparisons between those
+    two images are kept for it. Note the API compares every image it is sent,
+    so server work grows quadratically with the batch; keep batches small
+    (FACE_BATCH_SIZE). Cached pairs are not re-sent (check_cache=False skips
+    that lookup when the caller already did it), and if the batch request
+    fails as a whole each pair falls back to match_passport_and_selfie's own
+    retry policy.
+    
+    Returns:
+        One FaceMatchResult per pair, in the order given
+    """
+    results: List[Optional[FaceMatchResult]] = [None] * len(pairs)
+    pending: List[Tuple[int, Optional[Path]]] = []
+    if not use_cache:
+        pending = [(k, None) for k in range(len(pairs))]
+    else:
+        if digests is None:
+            digests = [(content_digest(p), content_digest(s)) for p, s in pairs]
+        for k, (passport_digest, selfie_digest) in enumerate(digests):
+            cache_path = _cache_path(passport_digest, selfie_digest, threshold)
+            cached = _load_cached(cache_path, save_crops) if check_cache else None
+            if cached is not None:
+                results[k] = cached
+            else:
+                pending.append((k, cache_path))
+    
+    response = None
+    if len(pending) > 1:
+        response = _post_batch([pairs[k] for k, _ in pending], save_crops)
+    
+    for j, (k, cache_path) in enumerate(pending):
+        if response is None:
+            results[k] = _request_match(pairs[k][0], pairs[k][1], threshold, save_crops, cache_path)
+            continue
+        # Keep only this pair's comparisons/detections (images 2j and 2j+1)
+        pair_response = {
+            "results": [r for r in response.get('results') or []
+                        if r.get('firstIndex', -1) // 2 == j and r.get('secondIndex', -1) // 2 == j
+                        and r.get('firstIndex') != r.get('secondIndex')],
+            "detections": [d for d in response.get('detections') or [] if d.get('imageIndex', -1) // 2 == j],
         }
+        match = _parse_results(pair_response, 0, threshold, save_crops)
+        if match is None:
+            match = FaceMatchResult(
+                similarity=0.0,
+                decision=False,
+                reason="no_valid_similarities_found",
+                meta={"api_method": "direct_rest_batch", "raw_response": pair_response if FACE_RETURN_META else None, "attempts": 1}
+            )
+        else:
+            match.meta["api_method"] = "direct_rest_batch"
+            match.meta["batch_size"] = len(pending)
+            _store_cached(cache_path, match)
+        results[k] = match
+    return results
+
+def _post_batch(pairs: List[Tuple[bytes, bytes]], save_crops: bool) -> Optional[Dict[str, Any]]:
+    """Send one multi-pair match request; None means the caller should fall back to single requests."""
+    if _circuit_open() is not None:
+        return None
+    try:
+        response = get_session().post(
+            f"{FACE_API_URL}/api/match",
+            data=_build_batch_request(pairs, save_crops),
+            timeout=_attempt_timeout(0) * len(pairs)
+        )
+        if response.status_code != 200:
+            logger.warning(f"⚠️  Batch match returned HTTP {response.status_code}, matching {len(pairs)} pairs one by one")
+            return None
+        result = _json_loads(response.content)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.warning(f"⚠️  Batch match failed ({e}), matching {len(pairs)} pairs one by one")
+        return None
+    if not result.get('results'):
+        logger.warning(f"⚠️  Batch match returned no results, matching {len(pairs)} pairs one by one")
+        return None
+    return result
+
+def _request_match(passport_bytes: bytes, selfie_bytes: bytes, threshold: float, save_crops: bool, cache_path: Optional[Path]) -> FaceMatchResult:
+    tripped = _circuit_open()
+    if tripped is not None:
+        return tripped
+    
+    # Use direct REST API with detectAll=True (EXACT website format)
+    try:
+        session = get_session()
+        body = _build_request(passport_bytes, selfie_bytes, save_crops)
         
         # Send direct REST request with retries and exponential backoff
-        max_retries = API_MAX_RETRIES
-        base_timeout = API_TIMEOUT
-        
-        for attempt in range(max_retries):
+        for attempt in range(API_MAX_RETRIES):
             try:
-                timeout = base_timeout + (attempt * 10)  # Increase timeout with each retry
-                response = requests.post(
+                response = session.post(
                     f"{FACE_API_URL}/api/match",
-                    json=request_data,
-                    headers={"Content-Type": "application/json"},
-                    timeout=timeout
+                    data=body,
+                    timeout=_attempt_timeout(attempt)
                 )
-                
-                # Check for retryable status codes
-                retryable_codes = [429, 502, 503, 504]  # Rate limit, Bad Gateway, Service Unavailable, Gateway Timeout
-                if response.status_code in retryable_codes:
-                    if attempt < max_retries - 1:
-                        # Exponential backoff with jitter
-                        wait_time = (2 ** attempt) + random.uniform(0, 1)
-                        error_name = {
-                            429: "Rate limited",
-                            502: "Bad Gateway", 
-                            503: "Service Unavailable",
-                            504: "Gateway Timeout"
-                        }.get(response.status_code, f"HTTP {response.status_code}")
-                        print(f"⏱️  {error_name}, waiting {wait_time:.1f}s before retry {attempt + 2}/{max_retries}...")
-                        time.sleep(wait_time)
-                        continue
-                    else:
-                        print(f"❌ {response.status_code} error exceeded after {max_retries} attempts")
-                        return FaceMatchResult(
-                            similarity=0.0,
-                            decision=False,
-                            reason=f"http_{response.status_code}_exceeded",
-                            meta={"api_method": "direct_rest", "error": f"HTTP {response.status_code}", "attempts": max_retries}
-                        )
-                
-                # For non-retryable status codes, break out of retry loop
-                if response.status_code != 200:
-                    break
-                    
-                # Process successful response
-                try:
-                    result = response.json()
-                except json.JSONDecodeError:
-                    if attempt < max_retries - 1:
-                        wait_time = API_TIMEOUT_RETRY_WAIT  # Fixed wait time for invalid responses
-                        print(f"⏱️  Invalid JSON response, waiting {wait_time}s before retry {attempt + 2}/{max_retries}...")
-                        time.sleep(wait_time)
-                        continue
-                    else:
-                        return FaceMatchResult(
-                            similarity=0.0,
-                            decision=False,
-                            reason="invalid_json_response",
-                            meta={"api_method": "direct_rest", "error": "Invalid JSON response", "attempts": max_retries}
-                        )
-                
-                # Check if results exist and are valid
-                if 'results' in result and result['results']:
-                    # Extract all similarity scores and find the BEST one
-                    all_similarities = []
-                    best_similarity = 0.0
-                    
-                    for match_result in result['results']:
-                        if 'similarity' in match_result:
-                            sim = float(match_result['similarity'])
-                            all_similarities.append(sim)
-                            if sim > best_similarity:
-                                best_similarity = sim
-                    
-                    if not all_similarities:
-                        # No valid similarities found - return immediately (no retry)
-                        return FaceMatchResult(
-                            similarity=0.0,
-                            decision=False,
-                            reason="no_valid_similarities_found",
-                            meta={"api_method": "direct_rest", "raw_response": result, "attempts": attempt + 1}
-                        )
-                    
-                    # Success! Process the results
-                    sim = best_similarity
-                    decision = sim >= threshold
-                    
-                    # Create detailed reason with face comparison info
-                    total_comparisons = len(all_similarities)
-                    if total_comparisons > 1:
-                        reason = f"ok (best of {total_comparisons} face comparisons)" if decision else f"below threshold {threshold} (best of {total_comparisons} face comparisons)"
-                    else:
-                        reason = "ok" if decision else f"below threshold {threshold}"
-
-                    # Enhanced metadata with detailed face comparison info
-                    meta = {
-                        "api_method": "direct_rest_detectall",
-                        "total_face_comparisons": total_comparisons,
-                        "all_similarities": all_similarities,
-                        "best_similarity": best_similarity,
-                        "average_similarity": sum(all_similarities) / len(all_similarities) if all_similarities else 0.0,
-                        "multiple_faces_detected": total_comparisons > 1,
-                        "ghost_portrait_handling": True,
-                        "detection_mode": "detectAll_true_both_images",
-                        "website_compatible": True,
-                        "retries_used": attempt
-                    }
-                    
-                    return FaceMatchResult(similarity=sim, decision=decision, reason=reason, meta=meta)
-                    
-                else:
-                    # No results in response - could be API overload, retry
-                    if attempt < max_retries - 1:
-                        wait_time = API_TIMEOUT_RETRY_WAIT  # Fixed wait time for API overload
-                        print(f"⏱️  API returned no results, waiting {wait_time}s before retry {attempt + 2}/{max_retries}...")
-                        time.sleep(wait_time)
-                        continue
-                    else:
-                        return FaceMatchResult(
-                            similarity=0.0,
-                            decision=False,
-                            reason="rest_api_no_results",
-                            meta={"api_method": "direct_rest", "raw_response": result, "attempts": max_retries}
-                        )
-                
             except requests.exceptions.Timeout:
-                if attempt < max_retries - 1:
-                    wait_time = API_TIMEOUT_RETRY_WAIT  # Fixed wait time for timeouts
-                    print(f"⏱️  Request timeout, waiting {wait_time}s before retry {attempt + 2}/{max_retries}...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    print(f"❌ Request timeout after {max_retries} attempts")
-                    return FaceMatchResult(
-                        similarity=0.0,
-                        decision=False,
-                        reason="request_timeout",
-                        meta={"api_method": "direct_rest", "error": "Request timeout", "attempts": max_retries}
-                    )
+                match, wait_time = _on_timeout(attempt)
             except requests.exceptions.RequestException as e:
-                if attempt < max_retries - 1:
-                    wait_time = (2 ** attempt) + random.uniform(0, 1)
-                    print(f"⏱️  Request error ({e}), waiting {wait_time:.1f}s before retry {attempt + 2}/{max_retries}...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    print(f"❌ Request failed after {max_retries} attempts: {e}")
-                    return FaceMatchResult(
-                        similarity=0.0,
-                        decision=False,
-                        reason="request_failed",
-                        meta={"api_method": "direct_rest", "error": str(e), "attempts": max_retries}
-                    )
-        
-        # If we exit the retry loop, handle non-200 responses
-        if response.status_code != 200:
-            return FaceMatchResult(
-                similarity=0.0,
-                decision=False,
-                reason=f"rest_api_error_{response.status_code}",
-                meta={"api_method": "direct_rest", "error": response.text, "attempts": max_retries}
-            )
+                match, wait_time = _on_request_error(e, attempt)
+            else:
+                match, wait_time = _on_response(response.status_code, response.content, attempt, threshold, save_crops, cache_path)
+            
+            if match is not None:
+                return match
+            time.sleep(wait_time)
             
     except Exception as e:
-        print(f"❌ REST API approach failed: {e}")
+        logger.error(f"❌ REST API approach failed: {e}")
         return FaceMatchResult(
             similarity=0.0,
             decision=False,
             reason=f"rest_api_exception: {str(e)}",
+            api_error=True,
             meta={"api_method": "direct_rest", "error": str(e)}
         )
+
+# The helpers below hold the request format and retry policy shared by the
+# sync client above and the asyncio client in face_client_async.py. Each
+# attempt ends in an Outcome: either a final FaceMatchResult, or None plus
+# the number of seconds to wait before the next attempt.
+Outcome = Tuple[Optional[FaceMatchResult], float]
+
+# Retryable status codes: Rate limit, Bad Gateway, Service Unavailable, Gateway Timeout
+RETRYABLE_STATUS = {
+    429: "Rate limited",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+    504: "Gateway Timeout",
+}
+
+def _preprocess(img_bytes: bytes) -> bytes:
+    """Shrink an image to FACE_PREPROCESS_MAX_SIDE and re-encode it as JPEG, if enabled.
+
+    The detector only needs a few hundred pixels of face, while scans are often
+    several MB, so this mostly cuts upload time. Any image that is already small
+    enough, or that Pillow can't read, is sent unchanged.
+    """
+    if not (FACE_PREPROCESS and PIL_AVAILABLE):
+        return img_bytes
+    from PIL import Image, ImageOps
+    
+    try:
+        with Image.open(io.BytesIO(img_bytes)) as img:
+            if max(img.size) <= FACE_PREPROCESS_MAX_SIDE:
+                return img_bytes
+            img = ImageOps.exif_transpose(img)  # the EXIF orientation tag is not kept
+            img.thumbnail((FACE_PREPROCESS_MAX_SIDE, FACE_PREPROCESS_MAX_SIDE), Image.Resampling.LANCZOS)
+            buf = io.BytesIO()
+            img.convert("RGB").save(buf, "JPEG", quality=FACE_PREPROCESS_QUALITY)
+            return buf.getvalue()
+    except Exception as e:
+        logger.warning(f"⚠️  Image preprocessing failed, sending original: {e}")
+        return img_bytes
+
+# Base64 of preprocessed images by content digest, least recently used first
+_ENCODED: "OrderedDict[bytes, bytes]" = OrderedDict()
+_ENCODED_LOCK = threading.Lock()
+
+def _encode_image(img_bytes: bytes) -> bytes:
+    """Base64 of the image as sent to the API, reusing earlier work for a repeated image.
+
+    Only preprocessed images are cached: resizing is the expensive part, and
+    the results are small. Plain base64 of the original is as cheap as the
+    hash that would be needed to look it up.
+    """
+    if not (FACE_PREPROCESS and PIL_AVAILABLE and FACE_ENCODE_CACHE_SIZE):
+        return base64.b64encode(_preprocess(img_bytes))
+    key = content_digest(img_bytes)
+    with _ENCODED_LOCK:
+        encoded = _ENCODED.get(key)
+        if encoded is not None:
+            _ENCODED.move_to_end(key)
+            return encoded
+    
+    encoded = base64.b64encode(_preprocess(img_bytes))
+    with _ENCODED_LOCK:
+        _ENCODED[key] = encoded
+        if len(_ENCODED) > FACE_ENCODE_CACHE_SIZE:
+            _ENCODED.popitem(last=False)
+    return encoded
+
+def _image_entry(img_bytes: bytes, index: int) -> List[bytes]:
+    # EXACT website format with detectAll=True:
+    # {"data": <base64>, "index": <index>, "detectAll": true, "type": 3}
+    return [
+        b'{"data":"',
+        _encode_image(img_bytes),
+        b'","index":%d,"detectAll":true,"type":3}' % index,
+    ]
+
+def _build_request(passport_bytes: bytes, selfie_bytes: bytes, save_crops: bool) -> bytes:
+    return _build_batch_request([(passport_bytes, selfie_bytes)], save_crops)
+
+def _build_batch_request(pairs: List[Tuple[bytes, bytes]], save_crops: bool) -> bytes:
+    """Serialized JSON body for /api/match.
+
+    /api/match only takes base64 images inside JSON, so the body is built
+    once here and the same bytes are re-sent on every retry. Base64 never
+    needs JSON escaping, so the encoded images are spliced in as bytes
+    rather than decoded to str and copied again by a JSON encoder.
+    """
+    # Pair k is images 2k (passport) and 2k+1 (selfie)
+    parts = [b'{"images":[']
+    for k, (passport_bytes, selfie_bytes) in enumerate(pairs):
+        if k:
+            parts.append(b',')
+        parts += _image_entry(passport_bytes, 2 * k)
+        parts.append(b',')
+        parts += _image_entry(selfie_bytes, 2 * k + 1)
+    parts.append(b'],"thumbnails":true}' if save_crops else b']}')
+    return b"".join(parts)
+
+def _attempt_timeout(attempt: int) -> int:
+    return API_TIMEOUT + (attempt * 10)  # Increase timeout with each retry
+
+def _is_last_attempt(attempt: int) -> bool:
+    return attempt >= API_MAX_RETRIES - 1
+
+def _backoff(attempt: int) -> float:
+    """Full-jitter exponential backoff: uniform in [0, min(API_TIMEOUT_RETRY_WAIT, API_RETRY_DELAY * 2^attempt)].
+
+    Spreading retries over the whole window keeps concurrent workers from
+    hitting a recovering API in lockstep.
+    """
+    return random.uniform(0, min(API_TIMEOUT_RETRY_WAIT, API_RETRY_DELAY * 2 ** attempt))
+
+def _give_up(result: FaceMatchResult) -> Outcome:
+    """Final Outcome for a call that failed because of the API; counts towards the circuit breaker."""
+    _record_failure()
+    return result, 0.0
+
+def _on_response(status_code: int, content: bytes, attempt: int, threshold: float, save_crops: bool, cache_path: Optional[Path]) -> Outcome:
+    """Turn one HTTP response from /api/match into an Outcome."""
+    max_retries = API_MAX_RETRIES
+    
+    # Check for retryable status codes
+    if status_code in RETRYABLE_STATUS:
+        if not _is_last_attempt(attempt):
+            wait_time = _backoff(attempt)
+            logger.warning(f"⏱️  {RETRYABLE_STATUS[status_code]}, waiting {wait_time:.1f}s before retry {attempt + 2}/{max_retries}...")
+            return None, wait_time
+        logger.warning(f"❌ {status_code} error exceeded after {max_retries} attempts")
+        return _give_up(FaceMatchResult(
+            similarity=0.0,
+            decision=False,
+            reason=f"http_{status_code}_exceeded",
+            api_error=True,
+            meta={"api_method": "direct_rest", "error": f"HTTP {status_code}", "attempts": max_retries}
+        ))
+    
+    # Non-retryable status codes end the call
+    if status_code != 200:
+        return FaceMatchResult(
+            similarity=0.0,
+            decision=False,
+            reason=f"rest_api_error_{status_code}",
+            api_error=True,
+            meta={"api_method": "direct_rest", "error": content.decode('utf-8', errors='replace'), "attempts": attempt + 1}
+        ), 0.0
+    
+    # Process successful response
+    try:
+        result = _json_loads(content)
+    except ValueError:
+        if not _is_last_attempt(attempt):
+            wait_time = _backoff(attempt)
+            logger.warning(f"⏱️  Invalid JSON response, waiting {wait_time:.1f}s before retry {attempt + 2}/{max_retries}...")
+            return None, wait_time
+        return _give_up(FaceMatchResult(
+            similarity=0.0,
+            decision=False,
+            reason="invalid_json_response",
+            api_error=True,
+            meta={"api_method": "direct_rest", "error": "Invalid JSON response", "attempts": max_retries}
+        ))
+    
+    # Check if results exist and are valid
+    if 'results' in result and result['results']:
+        _record_success()
+        match = _parse_results(result, attempt, threshold, save_crops)
+        if match is None:
+            # No valid similarities found - return immediately (no retry)
+            return FaceMatchResult(
+                similarity=0.0,
+                decision=False,
+                reason="no_valid_similarities_found",
+                meta={"api_method": "direct_rest", "raw_response": result if FACE_RETURN_META else None, "attempts": attempt + 1}
+            ), 0.0
+        _store_cached(cache_path, match)
+        return match, 0.0
+    
+    # No results in response - could be API overload, retry
+    if not _is_last_attempt(attempt):
+        wait_time = _backoff(attempt)
+        logger.warning(f"⏱️  API returned no results, waiting {wait_time:.1f}s before retry {attempt + 2}/{max_retries}...")
+        return None, wait_time
+    return _give_up(FaceMatchResult(
+        similarity=0.0,
+        decision=False,
+        reason="rest_api_no_results",
+        api_error=True,
+        meta={"api_method": "direct_rest", "raw_response": result if FACE_RETURN_META else None, "attempts": max_retries}
+    ))
+
+def _parse_results(result: Dict[str, Any], attempt: int, threshold: float, save_crops: bool) -> Optional[FaceMatchResult]:
+    """Pick the best face comparison out of a match response, or None if none has a similarity."""
+    # Extract all similarity scores and find the BEST one
+    all_similarities = []
+    best_similarity = 0.0
+    best_result = None
+    
+    for match_result in result['results']:
+        if 'similarity' in match_result:
+            sim = float(match_result['similarity'])
+            all_similarities.append(sim)
+            if best_result is None or sim > best_similarity:
+                best_similarity = sim
+                best_result = match_result
+    
+    if not all_similarities:
+        return None
+    
+    # Success! Process the results
+    sim = best_similarity
+    decision = sim >= threshold
+    
+    # Create detailed reason with face comparison info
+    total_comparisons = len(all_similarities)
+    if total_comparisons > 1:
+        reason = f"ok (best of {total_comparisons} face comparisons)" if decision else f"below threshold {threshold} (best of {total_comparisons} face comparisons)"
+    else:
+        reason = "ok" if decision else f"below threshold {threshold}"
+
+    # Enhanced metadata with detailed face comparison info
+    meta = {
+        "api_method": "direct_rest_detectall",
+        "total_face_comparisons": total_comparisons,
+        "all_similarities": all_similarities,
+        "best_similarity": best_similarity,
+        "average_similarity": sum(all_similarities) / len(all_similarities),
+        "multiple_faces_detected": total_comparisons > 1,
+        "ghost_portrait_handling": True,
+        "detection_mode": "detectAll_true_both_images",
+        "website_compatible": True,
+        "retries_used": attempt
+    }
+    
+    passport_crop = selfie_crop = None
+    if save_crops:
+        detections = result.get('detections')
+        passport_crop = _face_crop_b64(detections, best_result.get('firstIndex'), best_result.get('firstFaceIndex'))
+        selfie_crop = _face_crop_b64(detections, best_result.get('secondIndex'), best_result.get('secondFaceIndex'))
+    
+    return FaceMatchResult(
+        similarity=sim, decision=decision, reason=reason, meta=meta,
+        passport_crop_b64=passport_crop, selfie_crop_b64=selfie_crop
+    )
+
+def _on_timeout(attempt: int) -> Outcome:
+    max_retries = API_MAX_RETRIES
+    if not _is_last_attempt(attempt):
+        wait_time = _backoff(attempt)
+        logger.warning(f"⏱️  Request timeout, waiting {wait_time:.1f}s before retry {attempt + 2}/{max_retries}...")
+        return None, wait_time
+    logger.warning(f"❌ Request timeout after {max_retries} attempts")
+    return _give_up(FaceMatchResult(
+        similarity=0.0,
+        decision=False,
+        reason="request_timeout",
+        api_error=True,
+        meta={"api_method": "direct_rest", "error": "Request timeout", "attempts": max_retries}
+    ))
+
+def _on_request_error(e: Exception, attempt: int) -> Outcome:
+    max_retries = API_MAX_RETRIES
+    if not _is_last_attempt(attempt):
+        wait_time = _backoff(attempt)
+        logger.warning(f"⏱️  Request error ({e}), waiting {wait_time:.1f}s before retry {attempt + 2}/{max_retries}...")
+        return None, wait_time
+    logger.warning(f"❌ Request failed after {max_retries} attempts: {e}")
+    return _give_up(FaceMatchResult(
+        similarity=0.0,
+        decision=False,
+        reason="request_failed",
+        api_error=True,
+        meta={"api_method": "direct_rest", "error": str(e), "attempts": max_retries}
+    ))
@@ -0,0 +1,103 @@
+from __future__ import annotations
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+import aiohttp
+
+from ..utils.files import content_digest
+from .face_client import (
+    FACE_API_URL,
+    API_MAX_RETRIES,
+    FaceMatchResult,
+    _attempt_timeout,
+    _build_request,
+    _cache_path,
+    _circuit_open,
+    _load_cached,
+    _on_request_error,
+    _on_response,
+    _on_timeout,
+)
+
+logger = logging.getLogger(__name__)
+
+def create_session(concurrency: int) -> aiohttp.ClientSession:
+    """HTTP session whose connection pool is sized for `concurrency` requests in flight."""
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=concurrency),
+        headers={"Content-Type": "application/json"},
+    )
+
+async def match_async(session: aiohttp.ClientSession, passport_bytes: bytes, selfie_bytes: bytes, threshold: float = 0.85,
+                      save_crops: bool = False, digests: Optional[Tuple[bytes, bytes]] = None,
+                      use_cache: bool = True, check_cache: bool = True) -> FaceMatchResult:
+    """
+    Asyncio counterpart of face_client.match_passport_and_selfie.
+
+    Sends the same /api/match request and applies the same retry policy and
+    result cache, but waits on the event loop instead of holding a thread per
+    in-flight request.
+    """
+    cache_path = None
+    if use_cache:
+        if digests is None:
+            digests = (content_digest(passport_bytes), content_digest(selfie_bytes))
+        cache_path = _cache_path(digests[0], digests[1], threshold)
+        cached = _load_cached(cache_path, save_crops) if check_cache else None
+        if cached is not None:
+            return cached
+    tripped = _circuit_open()
+    if tripped is not None:
+        return tripped
+
+    try:
+        # Encoding (and optional resizing) is CPU work, keep it off the event loop
+        body = await asyncio.to_thread(_build_request, passport_bytes, selfie_bytes, save_crops)
+
+        for attempt in range(API_MAX_RETRIES):
+            try:
+                async with session.post(
+                    f"{FACE_API_URL}/api/match",
+                    data=body,
+                    timeout=aiohttp.ClientTimeout(total=_attempt_timeout(attempt))
+                ) as response:
+                    content = await response.read()
+            except asyncio.TimeoutError:
+                match, wait_time = _on_timeout(attempt)
+            except aiohttp.ClientError as e:
+                match, wait_time = _on_request_error(e, attempt)
+            else:
+                match, wait_time = _on_response(response.status, content, attempt, threshold, save_crops, cache_path)
+
+            if match is not None:
+                return match
+            await asyncio.sleep(wait_time)
+
+    except Exception as e:
+        logger.error(f"❌ Async REST API approach failed: {e}")
+        return FaceMatchResult(
+            similarity=0.0,
+            decision=False,
+            reason=f"rest_api_exception: {str(e)}",
+            api_error=True,
+            meta={"api_method": "direct_rest_async", "error": str(e)}
+        )
+
+def match_pairs(pairs: List[Tuple[bytes, bytes]], threshold: float = 0.85, save_crops: bool = False,
+                concurrency: int = 20, use_cache: bool = True) -> List[FaceMatchResult]:
+    """
+    Match many (passport_bytes, selfie_bytes) pairs concurrently from synchronous code.
+
+    Runs its own event loop with at most `concurrency` requests in flight and
+    returns the results in the same order as `pairs`.
+    """
+    async def run_all() -> List[FaceMatchResult]:
+        sem = asyncio.Semaphore(concurrency)
+        async with create_session(concurrency) as session:
+            async def bounded(passport_bytes: bytes, selfie_bytes: bytes) -> FaceMatchResult:
+                async with sem:
+                    return await match_async(session, passport_bytes, selfie_bytes, threshold, save_crops, use_cache=use_cache)
+            return await asyncio.gather(*[bounded(p, s) for p, s in pairs])
+
+    return asyncio.run(run_all())
@@ -0,0 +1,24 @@
+from __future__ import annotations
+from pathlib import Path
+
+def extract_id_from_filename(filepath: Path) -> str:
+    """Extract ID from filename by splitting on underscore and taking first part."""
+    filename = filepath.stem
+    parts = filename.split('_')
+    return parts[0] if parts else filename
+
+def should_files_match(passport_id: str, face_photo_id: str) -> bool:
+    """Check if files should match based on their filename IDs."""
+    # Return True if both IDs are non-empty and match
+    return bool(passport_id and face_photo_id and passport_id == face_photo_id)
+
+def assess_match_result(should_match: bool, actual_match: bool) -> str:
+    """Assess the difference between expected and actual match results."""
+    if should_match and actual_match:
+        return "true_positive"
+    elif not should_match and not actual_match:
+        return "true_negative"
+    elif should_match and not actual_match:
+        return "false_negative"
+    else:  # not should_match and actual_match
+        return "false_positive"
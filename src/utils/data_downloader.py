@@ -1,151 +1,334 @@
 from __future__ import annotations
 import os
 import json
+import logging
+import shutil
+import threading
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import closing
+from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 import pandas as pd
 from tqdm import tqdm
+from tqdm.contrib.logging import logging_redirect_tqdm
 import time
 
-def download_image(url: str, output_path: Path, timeout: int = 30, max_retries: int = 3) -> bool:
+logger = logging.getLogger(__name__)
+
+# Rows downloaded in parallel; each worker holds one connection from the shared session
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "16"))
+# CSV rows read into memory at a time; URL columns are detected from the first chunk
+CSV_CHUNK_ROWS = int(os.getenv("CSV_CHUNK_ROWS", "1000"))
+
+# orjson is optional; it writes the per-maid info.json files faster than json
+try:
+    import orjson
+    def _info_json(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY, default=str)
+except ImportError:
+    def _info_json(obj: Any) -> bytes:
+        return json.dumps(obj, indent=2, ensure_ascii=False, default=str).encode("utf-8")
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    """Write a file in one go via a temp file, so a crash never leaves it half-written."""
+    # A temp name of its own per process and thread, so concurrent writers never swap each other's files
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+def create_session(workers: int = DOWNLOAD_WORKERS) -> requests.Session:
+    """HTTP session whose keep-alive pool is sized for `workers` concurrent downloads."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def download_image(session: requests.Session, url: str, output_path: Path, timeout: int = 30, max_retries: int = 3) -> bool:
     """Download an image from URL to the specified path."""
     if not url or pd.isna(url) or str(url).strip() == '':
-        print(f"⚠️  Empty URL, skipping download to {output_path}")
+        logger.warning(f"⚠️  Empty URL, skipping download to {output_path}")
         return False
     
     output_path.parent.mkdir(parents=True, exist_ok=True)
     
     for attempt in range(max_retries):
         try:
-            response = requests.get(url, timeout=timeout, stream=True)
-            response.raise_for_status()
-            
-            with open(output_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+            with session.get(url, timeout=timeout, stream=True) as response:
+                response.raise_for_status()
+                # Copy straight from the socket in 1 MiB reads, still undoing any gzip/deflate
+                response.raw.decode_content = True
+                with open(output_path, 'wb') as f:
+                    shutil.copyfileobj(response.raw, f, 1 << 20)
             
-            print(f"✅ Downloaded: {output_path.name}")
+            logger.debug(f"✅ Downloaded: {output_path.name}")
             return True
             
-        except requests.exceptions.RequestException as e:
-            print(f"❌ Attempt {attempt + 1} failed for {url}: {e}")
+        # Reading response.raw directly surfaces urllib3's errors rather than requests' wrappers
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+            logger.warning(f"❌ Attempt {attempt + 1} failed for {url}: {e}")
             if attempt < max_retries - 1:
                 time.sleep(1)  # Wait before retry
             continue
     
-    print(f"❌ Failed to download after {max_retries} attempts: {url}")
+    logger.warning(f"❌ Failed to download after {max_retries} attempts: {url}")
     return False
 
-def process_csv_file(csv_path: Path, data_root: Path, category: str) -> Dict[str, int]:
-    """Process a single CSV file and download images."""
+def _merge_dtypes(kinds: set, had_gaps: bool, text_dtype: Any) -> Any:
+    """The dtype pandas infers for a whole column, from what it found in each chunk of it.
+
+    `kinds` are pandas' infer_dtype() names for the chunks where the column
+    had values, `had_gaps` tells whether it was ever empty, and `text_dtype`
+    is the dtype pandas gave it in a chunk of plain text. A bool column with
+    gaps comes back as "bool_with_gaps": pandas loads it as objects holding
+    True/False, which no dtype= value reproduces.
+    """
+    if not kinds:
+        return "float64"  # empty throughout
+    if kinds == {"integer"}:
+        # A gap turns a whole int column into float
+        return "float64" if had_gaps else "int64"
+    if kinds <= {"integer", "floating", "mixed-integer-float"}:
+        return "float64"
+    if kinds == {"boolean"}:
+        return "bool_with_gaps" if had_gaps else "bool"
+    if kinds == {"string"}:
+        return text_dtype
+    # Anything else (numbers mixed with text, say) is left as the text it was written as
+    return object
+
+def _scan_csv(csv_path: Path, url_candidates: List[str]) -> Tuple[Dict[str, Any], Dict[str, List[Any]], int]:
+    """One chunked pass over the CSV before any downloads.
+
+    Returns the dtype of every column as if the file had been loaded at once
+    (for _read_chunks, so every chunk types its values the same way), the
+    first three non-null values of each URL candidate column, and the number
+    of rows.
+    """
+    kinds: Dict[str, set] = {}
+    gaps: Dict[str, bool] = {}
+    text_dtypes: Dict[str, Any] = {}
+    samples: Dict[str, List[Any]] = {col: [] for col in url_candidates}
+    rows = 0
+    with pd.read_csv(csv_path, chunksize=CSV_CHUNK_ROWS) as reader:
+        for chunk in reader:
+            rows += len(chunk)
+            for col in chunk.columns:
+                values = chunk[col]
+                kinds.setdefault(col, set())
+                if values.isna().any():
+                    gaps[col] = True
+                if values.isna().all():
+                    continue  # an empty stretch says nothing about the type
+                kind = pd.api.types.infer_dtype(values, skipna=True)
+                kinds[col].add(kind)
+                if kind == "string":
+                    text_dtypes.setdefault(col, values.dtype)
+            for col in url_candidates:
+                needed = 3 - len(samples[col])
+                if needed > 0:
+                    samples[col] += chunk[col].dropna().head(needed).tolist()
+    dtypes = {col: _merge_dtypes(kinds[col], gaps.get(col, False), text_dtypes.get(col, object)) for col in kinds}
+    return dtypes, samples, rows
+
+# The spellings pandas reads as booleans
+_BOOL_TEXT = {"True": True, "TRUE": True, "true": True, "False": False, "FALSE": False, "false": False}
+
+def _read_chunks(csv_path: Path, dtypes: Dict[str, Any]):
+    """Chunked reader whose columns all have the dtypes _scan_csv found for the whole file."""
+    bool_cols = [col for col, dtype in dtypes.items() if isinstance(dtype, str) and dtype == "bool_with_gaps"]
+    dtype_arg = {col: (object if col in bool_cols else dtype) for col, dtype in dtypes.items()}
+    with pd.read_csv(csv_path, chunksize=CSV_CHUNK_ROWS, dtype=dtype_arg) as reader:
+        for chunk in reader:
+            for col in bool_cols:
+                chunk[col] = chunk[col].map(_BOOL_TEXT.get, na_action="ignore")
+            yield chunk
+
+def _url_candidates(columns: List[str]) -> List[str]:
+    """Columns whose name suggests they hold image URLs."""
+    return [
+        col for col in columns
+        if any(keyword in col.lower() for keyword in ['url', 'link', 'image', 'photo', 'face']) or
+           ('passport' in col.lower() and any(url_keyword in col.lower() for url_keyword in ['rejected', 'link', 'url', 'download']))
+    ]
+
+def _detect_url_columns(candidate_cols: List[str], samples: Dict[str, List[Any]]) -> List[str]:
+    """The candidate columns whose first few values really are URLs."""
+    image_url_columns = []
+    seen = set()
+    for col in candidate_cols:
+        # Avoid duplicate columns (like .1 suffix)
+        base = col.replace('.1', '').replace('.2', '')
+        if base in seen:
+            continue
+        # Check if this column actually contains URLs (not just passport numbers or other text)
+        if any('http' in str(value) for value in samples[col]):
+            seen.add(base)
+            image_url_columns.append(col)
+    return image_url_columns
+
+def _process_row(session: requests.Session, row: Dict[str, Any], maid_id_col: str, image_url_columns: List[str],
+                 csv_path: Path, data_root: Path, category: str, timestamp: str) -> bool:
+    """Download one maid's images and write its info.json; True if every image downloaded."""
+    maid_id = str(row[maid_id_col])
+    
+    # Create maid directory
+    maid_dir = data_root / category / maid_id
+    maid_dir.mkdir(parents=True, exist_ok=True)
+    
+    # Download images
+    download_success = True
+    downloaded_files: Dict[str, Any] = {}
+    
+    for i, url_col in enumerate(image_url_columns):
+        url = row.get(url_col, '')
+        if pd.isna(url) or str(url).strip() == '':
+            continue
+            
+        # Determine image type and create appropriate filename
+        if any(keyword in url_col.lower() for keyword in ['passport', 'document', 'id']):
+            filename = f"{maid_id}_passport.jpg"
+            image_type = "passport"
+        elif any(keyword in url_col.lower() for keyword in ['photo', 'face', 'selfie', 'live']):
+            filename = f"{maid_id}_face.jpg" 
+            image_type = "face_photo"
+        else:
+            # Default fallback based on column index
+            filename = f"{maid_id}_image_{i}.jpg"
+            image_type = f"image_{i}"
+        
+        output_path = maid_dir / filename
+        
+        success = download_image(session, url, output_path)
+        if success:
+            downloaded_files[image_type] = {
+                "filename": filename,
+                "url": str(url),
+                "column": url_col,
+                "path": str(output_path.relative_to(data_root.parent))
+            }
+        else:
+            download_success = False
+    
+    # Create info.json with all row data
+    info_data = {
+        "maid_id": maid_id,
+        "category": category,
+        "csv_source": str(csv_path.name),
+        "downloaded_images": downloaded_files,
+        "original_data": row,
+        "processing_timestamp": timestamp
+    }
+    
+    _write_atomic(maid_dir / "info.json", _info_json(info_data))
+    
+    return download_success and bool(downloaded_files)
+
+def _try_process_row(session: requests.Session, row: Dict[str, Any], maid_id_col: str, image_url_columns: List[str],
+                     csv_path: Path, data_root: Path, category: str, timestamp: str) -> bool:
+    """_process_row, but a row that fails is counted as failed instead of aborting the whole file."""
+    try:
+        return _process_row(session, row, maid_id_col, image_url_columns, csv_path, data_root, category, timestamp)
+    except Exception as e:
+        logger.warning(f"❌ Failed to process maid {row.get(maid_id_col)}: {e}")
+        return False
+
+def process_csv_file(csv_path: Path, data_root: Path, category: str, workers: int = DOWNLOAD_WORKERS,
+                     timestamp: Optional[str] = None) -> Dict[str, int]:
+    """Process a single CSV file and download images.
+
+    `timestamp` is recorded as processing_timestamp in every info.json (default: now).
+    """
     
     if not csv_path.exists():
         print(f"❌ CSV file not found: {csv_path}")
         return {"processed": 0, "success": 0, "failed": 0}
     
-    df = pd.read_csv(csv_path)
+    columns = pd.read_csv(csv_path, nrows=0).columns
     
     # Find maid ID column (handle various naming conventions)
     maid_id_col = None
-    for col in df.columns:
+    for col in columns:
         if col.lower().replace(' ', '_') in ['maid_id', 'maid_id', 'id'] or 'maid' in col.lower():
             maid_id_col = col
             break
     
     if not maid_id_col:
         print(f"❌ No maid ID column found in {csv_path}")
-        print(f"Available columns: {list(df.columns)}")
+        print(f"Available columns: {list(columns)}")
         return {"processed": 0, "success": 0, "failed": 0}
     
-    # Try to detect image URL columns
-    image_url_columns = []
-    for col in df.columns:
-        # Check if column contains URLs (not just passport numbers or other text)
-        if any(keyword in col.lower() for keyword in ['url', 'link', 'image', 'photo', 'face']) or \
-           ('passport' in col.lower() and any(url_keyword in col.lower() for url_keyword in ['rejected', 'link', 'url', 'download'])):
-            # Check if this column actually contains URLs by sampling first few non-null values
-            sample_values = df[col].dropna().head(3)
-            if any('http' in str(val) for val in sample_values):
-                # Avoid duplicate columns (like .1 suffix)
-                if not any(col.replace('.1', '').replace('.2', '') == existing.replace('.1', '').replace('.2', '') for existing in image_url_columns):
-                    image_url_columns.append(col)
-    
+    url_candidates = _url_candidates(list(columns))
+    dtypes, samples, n_rows = _scan_csv(csv_path, url_candidates)
+    image_url_columns = _detect_url_columns(url_candidates, samples)
     if not image_url_columns:
         print(f"⚠️  No image URL columns detected in {csv_path}")
-        print(f"Available columns: {list(df.columns)}")
+        print(f"Available columns: {list(columns)}")
         return {"processed": 0, "success": 0, "failed": 0}
     
-    print(f"📊 Processing {len(df)} rows from {csv_path}")
+    print(f"📊 Processing {n_rows} rows from {csv_path} ({CSV_CHUNK_ROWS} at a time)")
     print(f"🆔 Using maid ID column: {maid_id_col}")
     print(f"🔗 Detected image URL columns: {image_url_columns}")
     
     stats = {"processed": 0, "success": 0, "failed": 0}
+    if timestamp is None:
+        timestamp = datetime.now().isoformat()
     
-    for index, row in tqdm(df.iterrows(), total=len(df), desc=f"Processing {category}"):
-        stats["processed"] += 1
-        maid_id = str(row[maid_id_col])
-        
-        # Create maid directory
-        maid_dir = data_root / category / maid_id
-        maid_dir.mkdir(parents=True, exist_ok=True)
+    # Stream the file in chunks rather than loading it whole. Each column gets its
+    # whole-file dtype, so maid IDs (and so directory names, e.g. 123, or 123.0 if
+    # any ID is missing) and info.json values come out as if loaded at once.
+    reader = _read_chunks(csv_path, dtypes)
+    # Downloads are network-bound, so rows run on a bounded thread pool; the pool
+    # size (not a per-row sleep) is what limits the load on the image server
+    with closing(reader), create_session(workers) as session, ThreadPoolExecutor(max_workers=workers) as executor, \
+            tqdm(total=n_rows, desc=f"Processing {category}", unit="row") as progress, logging_redirect_tqdm():
+        # Rows are submitted as they are read, across chunk boundaries, with at most
+        # `window` of them running or waiting at once so the pool never idles between
+        # chunks and memory stays bounded. Rows that repeat a maid ID write the same
+        # directory, so one waits (in file order) until the maid's running row is done.
+        window = 2 * workers
+        running: Dict[Future, str] = {}
+        waiting: Dict[str, deque] = {}
+        outstanding = 0
         
-        # Download images
-        download_success = True
-        downloaded_files = {}
+        def submit(maid: str, row: Dict[str, Any]) -> None:
+            future = executor.submit(_try_process_row, session, row, maid_id_col, image_url_columns,
+                                     csv_path, data_root, category, timestamp)
+            running[future] = maid
         
-        for i, url_col in enumerate(image_url_columns):
-            url = row.get(url_col, '')
-            if pd.isna(url) or str(url).strip() == '':
-                continue
-                
-            # Determine image type and create appropriate filename
-            if any(keyword in url_col.lower() for keyword in ['passport', 'document', 'id']):
-                filename = f"{maid_id}_passport.jpg"
-                image_type = "passport"
-            elif any(keyword in url_col.lower() for keyword in ['photo', 'face', 'selfie', 'live']):
-                filename = f"{maid_id}_face.jpg" 
-                image_type = "face_photo"
-            else:
-                # Default fallback based on column index
-                filename = f"{maid_id}_image_{i}.jpg"
-                image_type = f"image_{i}"
-            
-            output_path = maid_dir / filename
-            
-            success = download_image(url, output_path)
-            if success:
-                downloaded_files[image_type] = {
-                    "filename": filename,
-                    "url": str(url),
-                    "column": url_col,
-                    "path": str(output_path.relative_to(data_root.parent))
-                }
-            else:
-                download_success = False
-        
-        # Create info.json with all row data
-        info_data = {
-            "maid_id": maid_id,
-            "category": category,
-            "csv_source": str(csv_path.name),
-            "downloaded_images": downloaded_files,
-            "original_data": row.to_dict(),
-            "processing_timestamp": pd.Timestamp.now().isoformat()
-        }
-        
-        info_path = maid_dir / "info.json"
-        with open(info_path, 'w', encoding='utf-8') as f:
-            json.dump(info_data, f, indent=2, ensure_ascii=False, default=str)
-        
-        if download_success and downloaded_files:
-            stats["success"] += 1
-        else:
-            stats["failed"] += 1
+        def collect() -> None:
+            nonlocal outstanding
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                maid = running.pop(future)
+                ok = future.result()
+                outstanding -= 1
+                stats["processed"] += 1
+                stats["success" if ok else "failed"] += 1
+                progress.update(1)
+                queued = waiting.get(maid)
+                if queued:
+                    submit(maid, queued.popleft())
+                    if not queued:
+                        del waiting[maid]
         
-        # Small delay to be respectful to servers
-        time.sleep(0.1)
+        for chunk in reader:
+            for row in chunk.to_dict("records"):
+                while outstanding >= window:
+                    collect()
+                maid = str(row[maid_id_col])
+                outstanding += 1
+                if maid in running.values() or maid in waiting:
+                    waiting.setdefault(maid, deque()).append(row)
+                else:
+                    submit(maid, row)
+        while running:
+            collect()
     
     return stats
 
@@ -163,6 +346,8 @@ def main(csv_files: Dict[str, str], data_root: str = "data") -> None:
     data_path.mkdir(parents=True, exist_ok=True)
     
     total_stats = {"processed": 0, "success": 0, "failed": 0}
+    # One timestamp for the whole run, stamped into every info.json
+    run_timestamp = datetime.now().isoformat()
     
     print(f"🚀 Starting image download process...")
     print(f"📁 Data root: {data_path.absolute()}")
@@ -172,7 +357,7 @@ def main(csv_files: Dict[str, str], data_root: str = "data") -> None:
         print(f"📋 Processing category: {category}")
         csv_path = Path(csv_file)
         
-        stats = process_csv_file(csv_path, data_path, category)
+        stats = process_csv_file(csv_path, data_path, category, timestamp=run_timestamp)
         
         # Update total stats
         for key in total_stats:
@@ -1,31 +1,55 @@
 from __future__ import annotations
+import hashlib
+import heapq
+import os
+import re
 from pathlib import Path
 from typing import Optional, Tuple, List
 
 PASSPORT_HINTS = ("pass", "passport", "doc", "mrz", "bio", "id")
 SELFIE_HINTS = ("selfie", "face", "live", "photo", "portrait")
 
+# One alternation per hint list, so each filename is scanned once instead of once per hint
+_PASSPORT_RE = re.compile("|".join(map(re.escape, PASSPORT_HINTS)))
+_SELFIE_RE = re.compile("|".join(map(re.escape, SELFIE_HINTS)))
+
 IMG_EXTS = {".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff"}
 
 def list_image_files(dir_path: Path) -> List[Path]:
-    return [p for p in dir_path.iterdir() if p.suffix.lower() in IMG_EXTS and p.is_file()]
+    # scandir's DirEntry answers is_file() from the directory listing itself on most filesystems
+    with os.scandir(dir_path) as entries:
+        return [Path(e.path) for e in entries if os.path.splitext(e.name)[1].lower() in IMG_EXTS and e.is_file()]
+
+def content_digest(data: bytes) -> bytes:
+    """Content digest of in-memory image bytes (same as file_digest of that file)."""
+    return hashlib.blake2b(data, digest_size=32).digest()
+
+def file_digest(path: Path) -> bytes:
+    """Content digest of a file, hashed from disk in 1 MiB blocks without loading it whole."""
+    h = hashlib.blake2b(digest_size=32)
+    with open(path, "rb", buffering=0) as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.digest()
 
 def choose_passport_and_selfie(images: List[Path]) -> Tuple[Optional[Path], Optional[Path]]:
     if not images:
         return None, None
     lower_map = {p: p.name.lower() for p in images}
-    passport = next((p for p, n in lower_map.items() if any(h in n for h in PASSPORT_HINTS)), None)
-    selfie   = next((p for p, n in lower_map.items() if any(h in n for h in SELFIE_HINTS)), None)
+    passport = next((p for p, n in lower_map.items() if _PASSPORT_RE.search(n)), None)
+    selfie   = next((p for p, n in lower_map.items() if _SELFIE_RE.search(n)), None)
+    if passport is not None and selfie is not None and passport != selfie:
+        return passport, selfie
 
     # fallback: first two images
-    if not passport and len(images) >= 1:
+    if not passport:
         passport = images[0]
     if not selfie and len(images) >= 2:
-        selfie = images[1] if images[1] != passport else (images[0] if len(images) > 1 else None)
+        selfie = images[1] if images[1] != passport else images[0]
 
     if passport is None or selfie is None or passport == selfie:
         # last fallback: try to split by size (passport often larger/wider)
-        imgs_sorted = sorted(images, key=lambda p: p.stat().st_size, reverse=True)
-        if len(imgs_sorted) >= 2:
-            passport, selfie = imgs_sorted[0], imgs_sorted[1]
+        largest = heapq.nlargest(2, images, key=lambda p: p.stat().st_size)
+        if len(largest) >= 2:
+            passport, selfie = largest
     return passport, selfie
@@ -1,92 +1,416 @@
 from __future__ import annotations
 import os
+import csv
+import functools
+import hashlib
+import importlib.util
+import itertools
+import json
+import logging
 import pickle
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator, List, Optional
 
-import pandas as pd
+from tqdm import tqdm
 
-# Google Sheets imports (optional)
-try:
+# Google Sheets libraries (optional). They take a while to import, so they are only
+# checked for here and imported when an upload actually runs; config checks stay cheap.
+def _installed(name: str) -> bool:
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ImportError:  # a dotted name whose parent package is missing
+        return False
+
+SHEETS_AVAILABLE = all(_installed(name) for name in ("gspread", "google_auth_oauthlib", "google.oauth2"))
+
+if TYPE_CHECKING:
     import gspread
-    from google_auth_oauthlib.flow import InstalledAppFlow
-    from google.auth.transport.requests import Request
-    SHEETS_AVAILABLE = True
-except ImportError:
-    SHEETS_AVAILABLE = False
+    from google.oauth2.credentials import Credentials
+
+logger = logging.getLogger(__name__)
 
 # Google Sheets configuration
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive.file"]
+TOKEN_PATH = "token.json"
+LEGACY_TOKEN_PATH = "token.pickle"  # read once if token.json doesn't exist yet
+# Upload in ranges of at most this many cells, several ranges per API call, to stay under request size limits
+# (typed CellData runs ~40 bytes a cell, so the defaults keep each call around 2 MB)
+SHEETS_CHUNK_CELLS = int(os.getenv("SHEETS_CHUNK_CELLS", "10000"))
+SHEETS_RANGES_PER_REQUEST = max(1, int(os.getenv("SHEETS_RANGES_PER_REQUEST", "5")))
+# Attempts per Sheets API call on rate limits (429) and server errors (5xx), at least 1
+SHEETS_MAX_RETRIES = max(1, int(os.getenv("SHEETS_MAX_RETRIES", "6")))
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+# Data writes in flight at once, and the per-user request quota they (and retries) are paced to
+SHEETS_CONCURRENCY = int(os.getenv("SHEETS_CONCURRENCY", "4"))
+SHEETS_REQUESTS_PER_MINUTE = int(os.getenv("SHEETS_REQUESTS_PER_MINUTE", "60"))
+# Skip the upload when this exact CSV was already uploaded to the same sheet
+SHEETS_SKIP_UNCHANGED = os.getenv("SHEETS_SKIP_UNCHANGED", "1").lower() in ("1", "true", "yes")
+UPLOAD_STATE_PATH = ".sheets_upload_state.json"  # sheet ID -> digest of the last CSV uploaded there
 
-def upload_to_sheets(csv_path: Path, sheet_id: Optional[str] = None, creds_path: Optional[str] = None) -> bool:
-    """Upload CSV results to Google Sheets. Returns True if successful."""
+class _RateLimiter:
+    """Lets at most `per_minute` calls start in any 60 second window (0 = unlimited)."""
     
-    # Get configuration from environment if not provided
-    if not sheet_id:
-        sheet_id = os.getenv("GOOGLE_SHEET_ID", "") or os.getenv("SPREADSHEET_ID", "")
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self._starts: deque = deque()
+        self._lock = threading.Lock()
+    
+    def wait(self) -> None:
+        if not self.per_minute:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._starts and now - self._starts[0] >= 60:
+                    self._starts.popleft()
+                if len(self._starts) < self.per_minute:
+                    self._starts.append(now)
+                    return
+                delay = 60 - (now - self._starts[0])
+            time.sleep(delay)
+
+_LIMITER = _RateLimiter(SHEETS_REQUESTS_PER_MINUTE)
+
+def _retry_delay(e: Exception, attempt: int) -> float:
+    """Seconds to wait before retrying: the server's Retry-After if given, else exponential backoff, plus jitter."""
+    response = getattr(e, "response", None)
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    try:
+        delay = float(retry_after) if retry_after is not None else 2 ** attempt
+    except ValueError:  # an HTTP date instead of seconds
+        delay = 2 ** attempt
+    return min(delay, 64) + random.random()
+
+def _retry(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Call a Sheets API method, retrying rate-limited, transient server and network failures.
+
+    Anything else (and the last failure once retries run out) is raised to the caller.
+    """
+    import gspread
+    import requests
+    
+    for attempt in range(SHEETS_MAX_RETRIES):
+        _LIMITER.wait()
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            status = e.response.status_code
+            if status not in RETRYABLE_STATUS or attempt >= SHEETS_MAX_RETRIES - 1:
+                raise
+            wait_time = _retry_delay(e, attempt)
+            logger.warning(f"⏱️  Sheets API returned {status}, waiting {wait_time:.1f}s before retry {attempt + 2}/{SHEETS_MAX_RETRIES}...")
+            time.sleep(wait_time)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt >= SHEETS_MAX_RETRIES - 1:
+                raise
+            wait_time = _retry_delay(e, attempt)
+            logger.warning(f"⏱️  Sheets request failed ({e}), waiting {wait_time:.1f}s before retry {attempt + 2}/{SHEETS_MAX_RETRIES}...")
+            time.sleep(wait_time)
+
+_BOOLS = {"True": True, "False": False}
+
+def _cell(value: str) -> Any:
+    """A CSV cell as the value to send: numbers and booleans natively, anything else as text.
+
+    Only cells that read back exactly as written are converted, so IDs with
+    leading zeros or more digits than a double holds stay text.
+    """
+    if value in _BOOLS:
+        return _BOOLS[value]
+    if not value or not (value[0].isdigit() or value[0] in "-."):
+        return value
+    try:
+        number = int(value)
+        return number if str(number) == value and abs(number) < 2 ** 53 else value
+    except ValueError:
+        pass
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    return number if repr(number) == value else value
+
+def _typed_rows(rows: Iterable[List[str]]) -> Iterator[List[Any]]:
+    for row in rows:
+        yield [_cell(value) for value in row]
+
+def _cell_data(value: Any) -> dict:
+    """CellData for one value, typed explicitly so the server stores it without parsing."""
+    if isinstance(value, bool):  # before int: bool is an int subclass
+        return {"userEnteredValue": {"boolValue": value}}
+    if isinstance(value, (int, float)):
+        return {"userEnteredValue": {"numberValue": value}}
+    if value == "":
+        return {}  # with fields=userEnteredValue, an empty CellData clears the cell
+    return {"userEnteredValue": {"stringValue": value}}
+
+def _count_rows(csv_path: Path) -> tuple[int, int]:
+    """(rows, width) of the CSV as upload_to_sheets reads it, blank lines skipped."""
+    rows = width = 0
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        for row in csv.reader(f):
+            if row:
+                rows += 1
+                width = max(width, len(row))
+    return rows, width
+
+def _chunks(rows: Iterable[List[Any]], size: int) -> Iterator[List[List[Any]]]:
+    it = iter(rows)
+    return iter(lambda: list(itertools.islice(it, size)), [])
+
+def _write_rows(sh, ws, rows: Iterable[List[Any]], width: int, lead: List[dict], total: int) -> int:
+    """Write rows to the sheet from A1 down as updateCells requests of at most SHEETS_CHUNK_CELLS cells.
+
+    SHEETS_RANGES_PER_REQUEST of them go in each spreadsheets.batchUpdate
+    call. The `lead` requests (grid size, header freeze, cleanup) ride in the
+    first call, which completes before any other is sent, so the grid is
+    big enough for the rest. After that up to SHEETS_CONCURRENCY calls are
+    in flight at once; every request names its own start row, so they can
+    land in any order. Rows are consumed as they are sent, so only the
+    in-flight calls' rows are held in memory. Returns the number of rows written.
+    """
+    def send(requests: List[dict], n_rows: int) -> None:
+        _retry(sh.batch_update, {"requests": requests})
+        progress.update(n_rows)
+    
+    chunk_rows = max(1, SHEETS_CHUNK_CELLS // max(1, width))
+    written = 0
+    batch, batch_rows = list(lead), 0
+    first = True
+    in_flight: deque[Future] = deque()
+    with ThreadPoolExecutor(max_workers=max(1, SHEETS_CONCURRENCY)) as executor, \
+            tqdm(total=total, desc="sheets", unit="row", leave=False) as progress:
+        for chunk in _chunks(rows, chunk_rows):
+            batch.append({"updateCells": {
+                "start": {"sheetId": ws.id, "rowIndex": written, "columnIndex": 0},
+                "rows": [{"values": [_cell_data(value) for value in row]} for row in chunk],
+                "fields": "userEnteredValue",
+            }})
+            written += len(chunk)
+            batch_rows += len(chunk)
+            if len(batch) - (len(lead) if first else 0) == SHEETS_RANGES_PER_REQUEST:
+                if first:
+                    send(batch, batch_rows)
+                    first = False
+                else:
+                    in_flight.append(executor.submit(send, batch, batch_rows))
+                    if len(in_flight) >= max(1, SHEETS_CONCURRENCY):
+                        in_flight.popleft().result()
+                batch, batch_rows = [], 0
+        if batch:
+            in_flight.append(executor.submit(send, batch, batch_rows))
+        for future in in_flight:
+            future.result()
+    return written
+
+def _get_credentials(creds_path: str) -> Optional["Credentials"]:
+    """Load the saved OAuth token, refreshing or re-authorizing only when it is no longer valid."""
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+    
+    creds = None
+    if os.path.exists(TOKEN_PATH):
+        creds = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
+    elif os.path.exists(LEGACY_TOKEN_PATH):
+        with open(LEGACY_TOKEN_PATH, "rb") as token:
+            creds = pickle.load(token)
     
-    if not creds_path:
-        creds_path = os.getenv("GOOGLE_CREDENTIALS_PATH", "credentials.json") or os.getenv("CREDENTIALS_PATH", "credentials.json")
+    if creds and creds.valid:
+        if not os.path.exists(TOKEN_PATH):
+            Path(TOKEN_PATH).write_text(creds.to_json(), encoding="utf-8")
+        return creds
+    
+    if creds and creds.expired and getattr(creds, "refresh_token", None):
+        creds.refresh(Request())
+    else:
+        if not os.path.exists(creds_path):
+            logger.error(f"❌ Credentials file not found: {creds_path}")
+            return None
+        flow = InstalledAppFlow.from_client_secrets_file(creds_path, SCOPES)
+        creds = flow.run_local_server(port=0)
+    
+    # Only written when the token actually changed
+    Path(TOKEN_PATH).write_text(creds.to_json(), encoding="utf-8")
+    return creds
+
+def _row_digest(row: List[str]) -> bytes:
+    return hashlib.blake2b(json.dumps(row).encode("utf-8"), digest_size=16).digest()
+
+def _csv_digest(csv_path: Path) -> str:
+    """Digest of the CSV's header and set of data rows, whatever order the rows are in.
+
+    main.py writes rows as maids finish, so two runs over the same data rarely
+    produce the same bytes; sorting per-row digests (16 bytes each) rather than
+    the rows themselves keeps the memory small.
+    """
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        rows = (row for row in csv.reader(f) if row)  # skip blank lines, as the upload does
+        header = next(rows, [])
+        row_digests = sorted(_row_digest(row) for row in rows)
+    h = hashlib.blake2b(_row_digest(header), digest_size=16)
+    for digest in row_digests:
+        h.update(digest)
+    return h.hexdigest()
+
+def _load_upload_state() -> dict:
+    try:
+        return json.loads(Path(UPLOAD_STATE_PATH).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+def _save_upload_state(sheet_id: str, digest: str) -> None:
+    state = _load_upload_state()
+    state[sheet_id] = digest
+    try:
+        Path(UPLOAD_STATE_PATH).write_text(json.dumps(state), encoding="utf-8")
+    except OSError as e:
+        logger.warning(f"⚠️  Could not record upload state in {UPLOAD_STATE_PATH}: {e}")
+
+# Authorized client reused by later uploads in the same process while its token is valid
+_CLIENT: Optional["gspread.Client"] = None
+_CLIENT_CREDS: Optional["Credentials"] = None
+
+def _get_client(creds_path: str) -> Optional["gspread.Client"]:
+    """Return an authorized gspread client, reusing the previous one while its token is still valid."""
+    import gspread
+    from requests.adapters import HTTPAdapter
+    
+    global _CLIENT, _CLIENT_CREDS
+    if _CLIENT is None or not (_CLIENT_CREDS and _CLIENT_CREDS.valid):
+        creds = _get_credentials(creds_path)
+        if creds is None:
+            return None
+        client = gspread.authorize(creds)
+        # Keep a keep-alive connection per parallel writer (the default pool holds 10);
+        # _retry handles retries, so urllib3 must not retry too
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(10, SHEETS_CONCURRENCY), max_retries=0)
+        client.http_client.session.mount("https://", adapter)
+        _CLIENT, _CLIENT_CREDS = client, creds
+    return _CLIENT
+
+def upload_to_sheets(csv_path: Path, sheet_id: Optional[str] = None, creds_path: Optional[str] = None,
+                     force: bool = False) -> bool:
+    """Upload CSV results to Google Sheets. Returns True if successful.
+
+    An unchanged CSV that was already uploaded to the same sheet is skipped
+    (and counts as success) unless `force` is set or SHEETS_SKIP_UNCHANGED=0.
+    """
+    
+    # Get configuration from environment if not provided
+    env_sheet_id, env_creds_path = get_sheets_config()
+    sheet_id = sheet_id or env_sheet_id
+    creds_path = creds_path or env_creds_path
     
     # Validation checks
     if not SHEETS_AVAILABLE:
-        print("⚠️  Google Sheets libraries not available. Install with: pip install gspread google-auth-oauthlib")
+        logger.warning("⚠️  Google Sheets libraries not available. Install with: pip install gspread google-auth-oauthlib")
         return False
     
     if not sheet_id:
-        print("⚠️  Google Sheets ID not configured. Set GOOGLE_SHEET_ID or SPREADSHEET_ID in .env")
+        logger.warning("⚠️  Google Sheets ID not configured. Set GOOGLE_SHEET_ID or SPREADSHEET_ID in .env")
         return False
     
     if not csv_path.exists():
-        print(f"❌ CSV file not found: {csv_path}")
+        logger.error(f"❌ CSV file not found: {csv_path}")
         return False
     
+    import gspread
+    import requests
+    from google.auth.exceptions import GoogleAuthError
+    
     try:
+        digest = _csv_digest(csv_path)
+        if SHEETS_SKIP_UNCHANGED and not force and _load_upload_state().get(sheet_id) == digest:
+            print("✅ Results unchanged since the last upload, Google Sheets is up to date")
+            return True
+        
         print("📊 Uploading results to Google Sheets...")
         
-        # Load CSV data
-        df = pd.read_csv(csv_path)
-        if df.empty:
-            print("⚠️  CSV file is empty, nothing to upload")
+        # Counted up front: unlike values updates, updateCells doesn't grow the grid
+        total, width = _count_rows(csv_path)
+        if total < 2:
+            logger.warning("⚠️  CSV file is empty, nothing to upload")
             return False
         
         # Authenticate with Google
-        creds = None
-        token_path = "token.pickle"
-        
-        if os.path.exists(token_path):
-            with open(token_path, "rb") as token:
-                creds = pickle.load(token)
+        gc = _get_client(creds_path)
+        if gc is None:
+            return False
         
-        if not creds or not creds.valid:
-            if creds and creds.expired and getattr(creds, "refresh_token", None):
-                creds.refresh(Request())
-            else:
-                if not os.path.exists(creds_path):
-                    print(f"❌ Credentials file not found: {creds_path}")
-                    return False
-                flow = InstalledAppFlow.from_client_secrets_file(creds_path, SCOPES)
-                creds = flow.run_local_server(port=0)
-            
-            with open(token_path, "wb") as token:
-                pickle.dump(creds, token)
+        sh = _retry(gc.open_by_key, sheet_id)
+        ws = sh.sheet1
+        # Sent with the first rows: grow the grid to fit and freeze the header row,
+        # then clear what's left of older, larger uploads (values only, as ws.clear()
+        # did) below and to the right. Those cells don't overlap the new rows, so the
+        # overwrite never shows the sheet empty. row_count/col_count are the grid
+        # size before the write; there is nothing to clear past them.
+        lead = [{"updateSheetProperties": {
+            "properties": {"sheetId": ws.id, "gridProperties": {
+                "rowCount": max(total, ws.row_count),
+                "columnCount": max(width, ws.col_count),
+                "frozenRowCount": 1,
+            }},
+            "fields": "gridProperties(rowCount,columnCount,frozenRowCount)",
+        }}]
+        if total < ws.row_count:
+            lead.append({"updateCells": {
+                "range": {"sheetId": ws.id, "startRowIndex": total},
+                "fields": "userEnteredValue",
+            }})
+        if width < ws.col_count:
+            lead.append({"updateCells": {
+                "range": {"sheetId": ws.id, "endRowIndex": total, "startColumnIndex": width},
+                "fields": "userEnteredValue",
+            }})
         
-        # Upload to sheets
-        gc = gspread.authorize(creds)
-        ws = gc.open_by_key(sheet_id).sheet1
-        ws.clear()
-        ws.update("A1", [df.columns.tolist()] + df.astype(str).values.tolist())
-        ws.freeze(rows=1)
+        # Stream the CSV; numeric and boolean cells are sent as such so the sheet
+        # can sort, sum and format them (header cells always stay text)
+        with open(csv_path, newline="", encoding="utf-8") as f:
+            rows = (row for row in csv.reader(f) if row)  # skip blank lines
+            header = next(rows, None)
+            if header is None:  # emptied since it was counted
+                logger.warning("⚠️  CSV file is empty, nothing to upload")
+                return False
+            written = _write_rows(sh, ws, itertools.chain([header], _typed_rows(rows)), width, lead, total)
         
-        print(f"✅ Successfully uploaded {len(df)} rows to Google Sheets!")
+        _save_upload_state(sheet_id, digest)
+        print(f"✅ Successfully uploaded {written - 1} rows to Google Sheets!")
         return True
         
+    # Retryable API and network errors were already retried by _retry; what reaches
+    # here needs fixing before the next run, so report it and leave the sheet as is
+    except gspread.exceptions.SpreadsheetNotFound:
+        logger.error(f"❌ Google Sheet {sheet_id} not found, or not shared with the authorized account")
+    except gspread.exceptions.APIError as e:
+        logger.error(f"❌ Google Sheets API error (HTTP {e.response.status_code}): {e.error.get('message', e)}")
+    except GoogleAuthError as e:
+        logger.error(f"❌ Google authorization failed: {e}. Delete {TOKEN_PATH} to sign in again")
+    except requests.exceptions.RequestException as e:
+        logger.error(f"❌ Could not reach Google Sheets: {e}")
+    except OSError as e:
+        logger.error(f"❌ Could not read or write {getattr(e, 'filename', None) or 'upload files'}: {e}")
+    except (ValueError, KeyError) as e:
+        # Malformed token.json / credentials file, or a CSV that isn't UTF-8
+        logger.error(f"❌ Invalid Sheets credentials or results file: {e}")
     except Exception as e:
-        print(f"❌ Failed to upload to Google Sheets: {e}")
-        return False
+        # Anything else (an unreadable token.pickle, an OAuth flow error, other gspread
+        # errors) must not crash the run after its results CSV was written
+        logger.error(f"❌ Failed to upload to Google Sheets: {type(e).__name__}: {e}")
+    return False
 
+@functools.lru_cache(maxsize=1)
 def get_sheets_config() -> tuple[str, str]:
-    """Get Google Sheets configuration from environment variables."""
+    """Get Google Sheets configuration from environment variables.
+
+    Read once per process (after load_dotenv); call get_sheets_config.cache_clear()
+    to pick up changed environment variables.
+    """
     sheet_id = os.getenv("GOOGLE_SHEET_ID", "") or os.getenv("SPREADSHEET_ID", "")
     creds_path = os.getenv("GOOGLE_CREDENTIALS_PATH", "credentials.json") or os.getenv("CREDENTIALS_PATH", "credentials.json")
     return sheet_id, creds_path
@@ -104,6 +428,7 @@ def main():
     # Load environment variables
     from dotenv import load_dotenv
     load_dotenv()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper(), format="%(message)s")
     
     # Get CSV path from environment or command line
     csv_path = os.getenv("RESULTS_CSV", "results/face_results.csv")